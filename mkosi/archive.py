@@ -1,13 +1,18 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import contextlib
+import logging
 import os
 import shutil
-from collections.abc import Iterable
+import subprocess
+import sys
+from collections.abc import Iterable, Iterator
 from pathlib import Path
 from typing import Optional
 
-from mkosi.log import log_step
-from mkosi.run import bwrap, finalize_passwd_mounts
+from mkosi.log import ARG_DEBUG_SHELL, die, log_step
+from mkosi.run import bwrap, bwrap_cmd, finalize_passwd_mounts, foreground, run, run_env, spawn
+from mkosi.types import PathString, Popen
 
 
 def tar_binary() -> str:
@@ -21,6 +26,31 @@ def tar_binary() -> str:
     return "gtar" if shutil.which("gtar") else "tar"
 
 
+def tar_decompress_program(src: Path, *, stream: bool = False) -> list[str]:
+    # tar decompresses xz archives with a single thread by default. Archives compressed with multiple blocks
+    # can be decompressed in parallel, so use a parallel decoder if one is available. We check the magic bytes
+    # because archives are not always named after their compression format (e.g. the gentoo stage3 tarball).
+    # When the archive is streamed to tar, we can't peek at the data so we go by the suffix instead, which
+    # also means tar needs to be told about the compression as it can't detect it on a pipe either.
+    if stream:
+        if src.suffix != ".xz":
+            return []
+    else:
+        with src.open("rb") as f:
+            if f.read(6) != b"\xfd7zXZ\x00":
+                return []
+
+    if shutil.which("pixz"):
+        return ["--use-compress-program=pixz"]
+    if shutil.which("xz"):
+        return ["--use-compress-program=xz -T0"]
+
+    if stream:
+        die(f"xz not found, needed to decompress {src.name}", hint="Install xz or pixz")
+
+    return []
+
+
 def cpio_binary() -> str:
     return "gcpio" if shutil.which("gcpio") else "cpio"
 
@@ -57,31 +87,62 @@ def make_tar(src: Path, dst: Path) -> None:
     )
 
 
+def tar_extract_cmd(src: Path, dst: Path, *, stream: bool = False) -> list[PathString]:
+    return [
+        tar_binary(),
+        "--extract",
+        "--file", "-" if stream else src,
+        *tar_decompress_program(src, stream=stream),
+        "--directory", dst,
+        "--keep-directory-symlink",
+        "--no-overwrite-dir",
+        "--same-permissions",
+        "--same-owner" if (dst / "etc/passwd").exists() else "--numeric-owner",
+        "--same-order",
+        "--acls",
+        "--selinux",
+        "--xattrs",
+        "--force-local",
+        *tar_exclude_apivfs_tmp(),
+    ]
+
+
 def extract_tar(src: Path, dst: Path, log: bool = True) -> None:
     if log:
         log_step(f"Extracting tar archive {src}…")
     bwrap(
-        [
-            tar_binary(),
-            "--extract",
-            "--file", src,
-            "--directory", dst,
-            "--keep-directory-symlink",
-            "--no-overwrite-dir",
-            "--same-permissions",
-            "--same-owner" if (dst / "etc/passwd").exists() else "--numeric-owner",
-            "--same-order",
-            "--acls",
-            "--selinux",
-            "--xattrs",
-            "--force-local",
-            *tar_exclude_apivfs_tmp(),
-        ],
+        tar_extract_cmd(src, dst),
         # Make sure tar uses user/group information from the root directory instead of the host.
         options=finalize_passwd_mounts(dst) if (dst / "etc/passwd").exists() else [],
     )
 
 
+@contextlib.contextmanager
+def spawn_extract_tar(src: Path, dst: Path, stdin: int) -> Iterator[Popen]:
+    """
+    Like extract_tar(), but the archive is read from the stdin file descriptor and we don't wait for tar to
+    finish before returning, so that the archive can be fed to tar while it is being extracted. src is only used
+    to name the archive. tar is waited for when the context manager exits and CalledProcessError is raised if it
+    failed.
+    """
+    log_step(f"Extracting tar archive {src}…")
+    with bwrap_cmd(options=finalize_passwd_mounts(dst) if (dst / "etc/passwd").exists() else []) as cmdline:
+        # Use the same environment as bwrap() so tar behaves the same as in extract_tar().
+        proc = spawn([*cmdline, *tar_extract_cmd(src, dst, stream=True)], stdin=stdin, env=run_env())
+        try:
+            yield proc
+        finally:
+            proc.wait()
+            # Take back the terminal from tar's process group, like run() does.
+            foreground(new_process_group=False)
+
+        if proc.returncode != 0:
+            logging.error(f"Extracting tar archive {src} failed with exit code {proc.returncode}.")
+            if ARG_DEBUG_SHELL.get():
+                run([*cmdline, "sh"], stdin=sys.stdin, check=False, log=False)
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+
+
 def make_cpio(src: Path, dst: Path, files: Optional[Iterable[Path]] = None) -> None:
     if not files:
         files = src.rglob("*")
@@ -1,24 +1,65 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import concurrent.futures
+import functools
+import json
 import os
 import re
+import subprocess
+import urllib.error
 import urllib.parse
-import urllib.request
 from collections.abc import Sequence
 from pathlib import Path
+from typing import Optional
 
 from mkosi.architecture import Architecture
-from mkosi.archive import extract_tar
+from mkosi.archive import extract_tar, spawn_extract_tar
 from mkosi.distributions import DistributionInstaller, PackageType
+from mkosi.download import fetch, fetch_tee, urlopen
 from mkosi.log import ARG_DEBUG, complete_step, die
-from mkosi.run import apivfs_cmd, bwrap, chroot_cmd, run
+from mkosi.run import apivfs_cmd, bwrap, chroot_cmd
 from mkosi.state import MkosiState
 from mkosi.tree import copy_tree, rmtree
-from mkosi.types import PathString
-from mkosi.util import flatten, sort_packages
+from mkosi.util import glob_prefix, is_empty_dir, sort_packages, write_all
+
+ARCHITECTURES = {
+    Architecture.x86_64 : "amd64",
+    Architecture.arm64  : "arm64",
+    Architecture.arm    : "arm",
+}
+
+# Kernel image locations relative to the kernel source tree.
+KERNEL_IMAGES = {
+    Architecture.x86_64: "arch/x86/boot/bzImage",
+    Architecture.arm64: "arch/arm64/boot/Image.gz",
+    Architecture.arm: "arch/arm/boot/zImage",
+}
+
+FEATURES = (
+    # Disable sandboxing in emerge because we already do it in mkosi.
+    "-sandbox",
+    "-pid-sandbox",
+    "-ipc-sandbox",
+    "-network-sandbox",
+    "-userfetch",
+    "-userpriv",
+    "-usersandbox",
+    "-usersync",
+    "-ebuild-locks",
+    "parallel-install",
+)
+
+
+@functools.lru_cache(maxsize=None)
+def stage3_regex(arch: str) -> re.Pattern[str]:
+    # e.g.: 20230108T161708Z/stage3-amd64-nomultilib-systemd-mergedusr-20230108T161708Z.tar.xz
+    return re.compile(rf"^[0-9]+T[0-9]+Z/stage3-{arch}-llvm-systemd-mergedusr-[0-9]+T[0-9]+Z\.tar\.xz",
+                      re.MULTILINE)
 
 
 def invoke_emerge(state: MkosiState, packages: Sequence[str] = (), apivfs: bool = True) -> None:
+    stage3 = state.cache_dir / "stage3"
+
     bwrap(
         cmd=apivfs_cmd(state.root) + [
             # We can't mount the stage 3 /usr using `options`, because bwrap isn't available in the stage 3
@@ -26,7 +67,7 @@ def invoke_emerge(state: MkosiState, packages: Sequence[str] = (), apivfs: bool
             # using another bwrap exec.
             "bwrap",
             "--dev-bind", "/", "/",
-            "--bind", state.cache_dir / "stage3/usr", "/usr",
+            "--bind", stage3 / "usr", "/usr",
             "emerge",
             "--buildpkg=y",
             "--usepkg=y",
@@ -45,16 +86,18 @@ def invoke_emerge(state: MkosiState, packages: Sequence[str] = (), apivfs: bool
         network=True,
         options=[
             # TODO: Get rid of as many of these as possible.
-            "--bind", state.cache_dir / "stage3/etc", "/etc",
-            "--bind", state.cache_dir / "stage3/var", "/var",
+            "--bind", stage3 / "etc", "/etc",
+            "--bind", stage3 / "var", "/var",
             "--ro-bind", "/etc/resolv.conf", "/etc/resolv.conf",
             "--bind", state.cache_dir / "repos", "/var/db/repos",
-            *flatten(["--bind", str(d), str(d)] for d in (state.config.workspace_dir, state.config.cache_dir) if d),
+            *state.extra_binds,
         ],
-        env=dict(
-            PKGDIR=str(state.cache_dir / "binpkgs"),
-            DISTDIR=str(state.cache_dir / "distfiles"),
-        ) | ({"USE": "build"} if not apivfs else {}) | state.config.environment,
+        env={
+            "PKGDIR": str(state.cache_dir / "binpkgs"),
+            "DISTDIR": str(state.cache_dir / "distfiles"),
+            **({"USE": "build"} if not apivfs else {}),
+            **state.config.environment,
+        },
     )
 
 
@@ -82,36 +125,97 @@ class GentooInstaller(DistributionInstaller):
             f"releases/{arch}/autobuilds/latest-stage3.txt",
         )
 
-        with urllib.request.urlopen(stage3tsf_path_url) as r:
-            # e.g.: 20230108T161708Z/stage3-amd64-nomultilib-systemd-mergedusr-20230108T161708Z.tar.xz
-            regexp = rf"^[0-9]+T[0-9]+Z/stage3-{arch}-llvm-systemd-mergedusr-[0-9]+T[0-9]+Z\.tar\.xz"
-            all_lines = r.readlines()
-            for line in all_lines:
-                if (m := re.match(regexp, line.decode("utf-8"))):
-                    stage3_latest = Path(m.group(0))
-                    break
-            else:
-                die("profile names changed upstream?")
+        regexp = stage3_regex(arch)
+
+        # Remember what latest-stage3.txt pointed to last time so we can make a conditional request and skip
+        # parsing it again if it didn't change upstream.
+        meta = state.cache_dir / "latest-stage3.json"
+        try:
+            cached = json.loads(meta.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            cached = {}
+        if not isinstance(cached, dict) or cached.get("url") != stage3tsf_path_url:
+            cached = {}
+
+        headers: dict[str, str] = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        try:
+            with urlopen(stage3tsf_path_url, headers=headers) as r:
+                # The file is only a few kilobytes so decode it in one go and let the regex engine find the
+                # first matching line instead of matching line by line.
+                if not (m := regexp.search(r.read().decode("utf-8"))):
+                    die("profile names changed upstream?")
+
+                stage3_latest = Path(m.group(0))
+
+                # Write to a temporary file first so an interrupted write can't leave a truncated file behind.
+                tmp = meta.with_name(f".{meta.name}.tmp")
+                tmp.write_text(
+                    json.dumps(
+                        dict(
+                            url=stage3tsf_path_url,
+                            etag=r.headers.get("ETag"),
+                            last_modified=r.headers.get("Last-Modified"),
+                            stage3_latest=os.fspath(stage3_latest),
+                        )
+                    )
+                )
+                tmp.rename(meta)
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or "stage3_latest" not in cached:
+                raise e
+
+            stage3_latest = Path(cached["stage3_latest"])
 
         stage3_url = urllib.parse.urljoin(state.config.mirror, f"releases/{arch}/autobuilds/{stage3_latest}")
         stage3_tar = state.cache_dir / "stage3.tar"
         stage3 = state.cache_dir / "stage3"
 
-        with complete_step("Fetching latest stage3 snapshot"):
-            old = stage3_tar.stat().st_mtime if stage3_tar.exists() else 0
+        try:
+            old: Optional[float] = stage3_tar.stat().st_mtime
+        except FileNotFoundError:
+            old = None
 
-            cmd: list[PathString] = ["curl", "-L", "--progress-bar", "-o", stage3_tar, stage3_url]
-            if stage3_tar.exists():
-                cmd += ["--time-cond", stage3_tar]
+        if old is None:
+            # Nothing is cached yet, so extract the stage3 tarball while it is being downloaded instead of
+            # writing it to disk first and reading it back afterwards.
+            rmtree(stage3)
+            stage3.mkdir()
 
-            run(cmd)
+            with complete_step(f"Fetching latest stage3 snapshot and extracting it to {stage3}"):
+                rfd, wfd = os.pipe()
+                download: Optional[concurrent.futures.Future[None]] = None
+                try:
+                    # tar is spawned with a preexec_fn, which is not safe once other threads are running, so start
+                    # it before the download thread.
+                    with spawn_extract_tar(Path(stage3_latest.name), stage3, stdin=rfd):
+                        # Drop our copy of the read end so that the download fails with EPIPE instead of
+                        # blocking forever if tar exits early.
+                        os.close(rfd)
+                        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                            download = pool.submit(fetch_tee, stage3_url, stage3_tar, wfd)
+                except subprocess.CalledProcessError:
+                    # If tar failed on its own, the download fails with EPIPE as a consequence, so only report
+                    # the download error if it failed for some other reason, in which case tar failing on the
+                    # truncated archive is the consequence.
+                    if download and (e := download.exception()) and not isinstance(e, BrokenPipeError):
+                        raise e
+                    raise
 
-            if stage3_tar.stat().st_mtime > old:
-                rmtree(stage3)
+                assert download
+                download.result()
+        else:
+            with complete_step("Fetching latest stage3 snapshot"):
+                if fetch(stage3_url, stage3_tar, if_newer_than=old):
+                    rmtree(stage3)
 
         stage3.mkdir(exist_ok=True)
 
-        if not any(stage3.iterdir()):
+        if is_empty_dir(stage3):
             with complete_step(f"Extracting {stage3_tar.name} to {stage3}"):
                 extract_tar(stage3_tar, stage3)
 
@@ -120,25 +224,15 @@ class GentooInstaller(DistributionInstaller):
 
         copy_tree(state.config, state.pkgmngr, stage3, preserve_owner=False)
 
-        features = " ".join([
-            # Disable sandboxing in emerge because we already do it in mkosi.
-            "-sandbox",
-            "-pid-sandbox",
-            "-ipc-sandbox",
-            "-network-sandbox",
-            "-userfetch",
-            "-userpriv",
-            "-usersandbox",
-            "-usersync",
-            "-ebuild-locks",
-            "parallel-install",
-            *(["noman", "nodoc", "noinfo"] if state.config.with_docs else []),
-        ])
+        features = " ".join([*FEATURES, *(["noman", "nodoc", "noinfo"] if not state.config.with_docs else [])])
 
         # Setting FEATURES via the environment variable does not seem to apply to ebuilds in portage, so we
         # append to /etc/portage/make.conf instead.
-        with (stage3 / "etc/portage/make.conf").open("a") as f:
-            f.write(f"\nFEATURES=\"${{FEATURES}} {features}\"\n")
+        fd = os.open(stage3 / "etc/portage/make.conf", os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0o644)
+        try:
+            write_all(fd, f"\nFEATURES=\"${{FEATURES}} {features}\"\n".encode())
+        finally:
+            os.close(fd)
 
         chroot = chroot_cmd(
             stage3,
@@ -146,7 +240,7 @@ class GentooInstaller(DistributionInstaller):
         )
 
         bwrap(cmd=chroot + ["emerge-webrsync"], network=True,
-              options=flatten(["--bind", d, d] for d in (state.config.workspace_dir, state.config.cache_dir) if d))
+              options=state.extra_binds)
 
         invoke_emerge(state, packages=["sys-apps/baselayout"], apivfs=False)
 
@@ -154,26 +248,21 @@ class GentooInstaller(DistributionInstaller):
     def install_packages(cls, state: MkosiState, packages: Sequence[str], apivfs: bool = True) -> None:
         invoke_emerge(state, packages=packages, apivfs=apivfs)
 
-        for d in state.root.glob("usr/src/linux-*"):
-            kver = d.name.removeprefix("linux-")
-            kimg = d / {
-                Architecture.x86_64: "arch/x86/boot/bzImage",
-                Architecture.arm64: "arch/arm64/boot/Image.gz",
-                Architecture.arm: "arch/arm/boot/zImage",
-            }[state.config.architecture]
-            vmlinuz = state.root / "usr/lib/modules" / kver / "vmlinuz"
-            if not vmlinuz.exists() and not vmlinuz.is_symlink():
-                vmlinuz.symlink_to(os.path.relpath(kimg, start=vmlinuz.parent))
+        kimg = KERNEL_IMAGES[state.config.architecture]
+
+        for d in glob_prefix(state.root / "usr/src", "linux-"):
+            kver = d.removeprefix("linux-")
+            # usr/lib/modules/<kver>/vmlinuz -> usr/src/linux-<kver>/<kimg>
+            try:
+                os.symlink(f"../../../src/{d}/{kimg}", state.root / "usr/lib/modules" / kver / "vmlinuz")
+            except FileExistsError:
+                pass
 
     @staticmethod
     def architecture(arch: Architecture) -> str:
-        a = {
-            Architecture.x86_64 : "amd64",
-            Architecture.arm64  : "arm64",
-            Architecture.arm    : "arm",
-        }.get(arch)
+        a = ARCHITECTURES.get(arch)
 
         if not a:
-            die(f"Architecture {a} is not supported by Gentoo")
+            die(f"Architecture {arch} is not supported by Gentoo")
 
         return a
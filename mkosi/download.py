@@ -0,0 +1,254 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import atexit
+import concurrent.futures
+import contextlib
+import email.utils
+import http.client
+import os
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+from typing import Optional
+
+from mkosi.config import __version__
+from mkosi.log import die
+from mkosi.util import write_all
+
+CHUNK_SIZE = 1024 * 1024
+MAX_REDIRECTS = 10
+USER_AGENT = f"mkosi/{__version__}"
+
+# Idle keep-alive connections, keyed by scheme and host.
+CONNECTIONS: dict[tuple[str, str], list[http.client.HTTPConnection]] = {}
+CONNECTIONS_LOCK = threading.Lock()
+
+
+def http_date(timestamp: float) -> str:
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def get_connection(scheme: str, host: str) -> tuple[http.client.HTTPConnection, bool]:
+    with CONNECTIONS_LOCK:
+        if (idle := CONNECTIONS.get((scheme, host))):
+            return idle.pop(), True
+
+    if scheme == "https":
+        return http.client.HTTPSConnection(host), False
+
+    return http.client.HTTPConnection(host), False
+
+
+def put_connection(scheme: str, host: str, connection: http.client.HTTPConnection) -> None:
+    with CONNECTIONS_LOCK:
+        CONNECTIONS.setdefault((scheme, host), []).append(connection)
+
+
+@atexit.register
+def close_connections() -> None:
+    with CONNECTIONS_LOCK:
+        for idle in CONNECTIONS.values():
+            for connection in idle:
+                connection.close()
+
+        CONNECTIONS.clear()
+
+
+def request(
+    url: str,
+    method: str,
+    headers: Mapping[str, str],
+) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+    u = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(("", "", u.path or "/", u.query, ""))
+    headers = {"User-Agent": USER_AGENT, **headers}
+    connection, reused = get_connection(u.scheme, u.netloc)
+
+    try:
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+    except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        # The server might have closed an idle keep-alive connection in the meantime, so retry once on a
+        # fresh connection in that case.
+        connection.close()
+        if not reused:
+            raise
+
+        connection.request(method, path, headers=headers)
+        response = connection.getresponse()
+
+    return connection, response
+
+
+@contextlib.contextmanager
+def urlopen(
+    url: str,
+    *,
+    method: str = "GET",
+    headers: Mapping[str, str] = {},
+) -> Iterator[http.client.HTTPResponse]:
+    """
+    Like urllib.request.urlopen(), but keeps connections alive and reuses them for later requests to the same
+    host, which saves a TCP and TLS handshake for every request after the first one. As with urllib, redirects
+    are followed, the final URL is available as the url attribute of the response and an HTTPError is raised
+    for error responses (and 304 Not Modified). If a proxy is configured or the URL is not an http(s) URL (e.g.
+    file:// or ftp:// mirrors), we defer to urllib instead.
+    """
+    if urllib.request.getproxies() or urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+        with urllib.request.urlopen(urllib.request.Request(url, method=method, headers={"User-Agent": USER_AGENT, **headers})) as r:
+            yield r
+        return
+
+    for _ in range(MAX_REDIRECTS):
+        u = urllib.parse.urlsplit(url)
+        if u.scheme not in ("http", "https"):
+            die(f"Redirect to unsupported URL {url}")
+
+        scheme, host = u.scheme, u.netloc
+        connection, response = request(url, method, headers)
+        response.url = url
+
+        if response.status not in (301, 302, 303, 307, 308) or "Location" not in response.headers:
+            break
+
+        response.read()
+        put_connection(scheme, host, connection)
+        url = urllib.parse.urljoin(url, response.headers["Location"])
+        if response.status == 303 and method != "HEAD":
+            method = "GET"
+    else:
+        die(f"Too many redirects while fetching {url}")
+
+    if response.status >= 300:
+        response.read()
+        put_connection(scheme, host, connection)
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    try:
+        yield response
+    finally:
+        # Only hand the connection back if the response was read completely, otherwise there's still data
+        # pending on the connection and it can't be used for another request.
+        if response.length == 0 and not response.chunked:
+            response.read()
+
+        if response.isclosed():
+            put_connection(scheme, host, connection)
+        else:
+            connection.close()
+
+
+def download_range(url: str, fd: int, start: int, end: int) -> None:
+    with urlopen(url, headers={"Range": f"bytes={start}-{end}"}) as r:
+        if r.status != 206:
+            die(f"Expected partial content from {url} but got HTTP status {r.status}")
+
+        offset = start
+        while (buf := r.read(CHUNK_SIZE)):
+            offset += os.pwrite(fd, buf, offset)
+
+    if offset != end + 1:
+        die(f"Short read while downloading bytes {start}-{end} of {url}")
+
+
+def download_stream(url: str, *fds: int) -> Optional[str]:
+    with urlopen(url) as r:
+        size = 0
+        while (buf := r.read(CHUNK_SIZE)):
+            size += len(buf)
+            for fd in fds:
+                write_all(fd, buf)
+
+        # read() signals a connection that was closed early the same way as the end of the response, so check
+        # that we got everything.
+        if (length := r.headers.get("Content-Length")) is not None and size != int(length):
+            die(f"Short read while downloading {url}")
+
+        return r.headers.get("Last-Modified")
+
+
+def set_mtime(fd: int, last_modified: Optional[str]) -> None:
+    if last_modified:
+        mtime = email.utils.parsedate_to_datetime(last_modified).timestamp()
+        os.utime(fd, (mtime, mtime))
+
+
+@contextlib.contextmanager
+def download_file(dst: Path) -> Iterator[int]:
+    # Download to a temporary file first so that an interrupted download does not leave a truncated file
+    # behind that looks up to date.
+    tmp = dst.with_name(f".{dst.name}.download")
+    fd = os.open(tmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_CLOEXEC, 0o644)
+    try:
+        yield fd
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    finally:
+        os.close(fd)
+
+    tmp.rename(dst)
+
+
+def fetch(url: str, dst: Path, *, if_newer_than: Optional[float] = None, workers: int = 4) -> bool:
+    """
+    Download url to dst. If if_newer_than is set, the download is skipped if the remote file was not modified
+    since the given timestamp. If the server supports range requests, the file is downloaded in parallel using
+    the given number of workers. The modification time of dst is set to the remote modification time if the
+    server provides one.
+
+    Returns whether dst was (re)downloaded.
+    """
+    headers: dict[str, str] = {}
+    if if_newer_than is not None:
+        headers["If-Modified-Since"] = http_date(if_newer_than)
+
+    try:
+        with urlopen(url, method="HEAD", headers=headers) as r:
+            # Use the final URL so we don't follow the same redirects again for every range request.
+            url = r.url
+            size = int(r.headers.get("Content-Length", 0))
+            ranges = r.headers.get("Accept-Ranges") == "bytes"
+            last_modified = r.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise e
+
+    if if_newer_than is not None and last_modified:
+        if email.utils.parsedate_to_datetime(last_modified).timestamp() <= if_newer_than:
+            return False
+
+    with download_file(dst) as fd:
+        if ranges and size > CHUNK_SIZE and workers > 1:
+            os.ftruncate(fd, size)
+            step = -(-size // workers)
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [
+                    pool.submit(download_range, url, fd, start, min(start + step, size) - 1)
+                    for start in range(0, size, step)
+                ]
+                for f in concurrent.futures.as_completed(futures):
+                    f.result()
+        else:
+            download_stream(url, fd)
+
+        set_mtime(fd, last_modified)
+
+    return True
+
+
+def fetch_tee(url: str, dst: Path, fd: int) -> None:
+    """
+    Download url to dst while also writing the downloaded data to fd, e.g. a pipe to a process that consumes
+    the data as it arrives. fd is closed once the download finishes or fails.
+    """
+    try:
+        with download_file(dst) as out:
+            set_mtime(out, download_stream(url, out, fd))
+    finally:
+        os.close(fd)
@@ -2,6 +2,7 @@
 
 import asyncio
 import asyncio.tasks
+import contextlib
 import ctypes
 import ctypes.util
 import enum
@@ -19,7 +20,7 @@ import textwrap
 import threading
 from pathlib import Path
 from types import TracebackType
-from typing import Any, Awaitable, Mapping, Optional, Sequence, Tuple, Type
+from typing import Any, Awaitable, Iterator, Mapping, Optional, Sequence, Tuple, Type
 
 from mkosi.log import ARG_DEBUG, ARG_DEBUG_SHELL, die
 from mkosi.types import _FILE, CompletedProcess, PathString, Popen
@@ -150,6 +151,23 @@ def ensure_exc_info() -> Tuple[Type[BaseException], BaseException, TracebackType
     return (exctype, exc, tb)
 
 
+def run_env(env: Mapping[str, str] = {}) -> dict[str, str]:
+    """
+    The environment we run commands with: a minimal one instead of our own, so that the host's environment
+    (e.g. TAR_OPTIONS or the locale) can't change how commands behave.
+    """
+    e = dict(
+        PATH=os.environ["PATH"],
+        TERM=os.getenv("TERM", "vt220"),
+        LANG="C.UTF-8",
+    ) | dict(env)
+
+    if ARG_DEBUG.get():
+        e["SYSTEMD_LOG_LEVEL"] = "debug"
+
+    return e
+
+
 def run(
     cmdline: Sequence[PathString],
     check: bool = True,
@@ -174,14 +192,7 @@ def run(
         # output.
         stdout = sys.stderr
 
-    env = dict(
-        PATH=os.environ["PATH"],
-        TERM=os.getenv("TERM", "vt220"),
-        LANG="C.UTF-8",
-    ) | env
-
-    if ARG_DEBUG.get():
-        env["SYSTEMD_LOG_LEVEL"] = "debug"
+    env = run_env(env)
 
     if input is not None:
         assert stdin is None  # stdin and input cannot be specified together
@@ -220,6 +231,7 @@ def spawn(
     stderr: _FILE = None,
     user: Optional[int] = None,
     group: Optional[int] = None,
+    env: Optional[Mapping[str, str]] = None,
 ) -> Popen:
     if ARG_DEBUG.get():
         logging.info(f"+ {' '.join(str(s) for s in cmdline)}")
@@ -239,6 +251,7 @@ def spawn(
             text=True,
             user=user,
             group=group,
+            env=env,
             preexec_fn=foreground,
         )
     except FileNotFoundError:
@@ -265,17 +278,13 @@ def have_effective_cap(capability: Capability) -> bool:
     return (int(hexcap, 16) & (1 << capability.value)) != 0
 
 
-def bwrap(
-    cmd: Sequence[PathString],
+@contextlib.contextmanager
+def bwrap_cmd(
     *,
     network: bool = False,
     options: Sequence[PathString] = (),
-    log: bool = True,
     scripts: Mapping[str, Sequence[PathString]] = {},
-    env: Mapping[str, str] = {},
-    stdin: _FILE = None,
-    input: Optional[str] = None,
-) -> CompletedProcess:
+) -> Iterator[list[PathString]]:
     cmdline: list[PathString] = [
         "bwrap",
         "--dev-bind", "/", "/",
@@ -323,6 +332,21 @@ def bwrap(
             "sh", "-c", "chmod 1777 /tmp /dev/shm && exec $0 \"$@\"",
         ]
 
+        yield cmdline
+
+
+def bwrap(
+    cmd: Sequence[PathString],
+    *,
+    network: bool = False,
+    options: Sequence[PathString] = (),
+    log: bool = True,
+    scripts: Mapping[str, Sequence[PathString]] = {},
+    env: Mapping[str, str] = {},
+    stdin: _FILE = None,
+    input: Optional[str] = None,
+) -> CompletedProcess:
+    with bwrap_cmd(network=network, options=options, scripts=scripts) as cmdline:
         try:
             result = run([*cmdline, *cmd], env=env, log=False, stdin=stdin, input=input)
         except subprocess.CalledProcessError as e:
@@ -1,10 +1,12 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+from functools import cached_property
 from pathlib import Path
 
 from mkosi.config import MkosiArgs, MkosiConfig
 from mkosi.tree import make_tree
-from mkosi.util import umask
+from mkosi.types import PathString
+from mkosi.util import flatten, umask
 
 
 class MkosiState:
@@ -22,22 +24,27 @@ class MkosiState:
         self.install_dir.mkdir(exist_ok=True)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
 
-    @property
+    @cached_property
     def root(self) -> Path:
         return self.workspace / "root"
 
-    @property
+    @cached_property
     def staging(self) -> Path:
         return self.workspace / "staging"
 
-    @property
+    @cached_property
     def pkgmngr(self) -> Path:
         return self.workspace / "pkgmngr"
 
-    @property
+    @cached_property
     def cache_dir(self) -> Path:
         return self.config.cache_dir or self.workspace / f"cache/{self.config.distribution}~{self.config.release}"
 
-    @property
+    @cached_property
     def install_dir(self) -> Path:
         return self.workspace / "dest"
+
+    @cached_property
+    def extra_binds(self) -> list[PathString]:
+        """Bind mount options that make the workspace and cache directories available in the sandbox."""
+        return flatten(["--bind", d, d] for d in (self.config.workspace_dir, self.config.cache_dir) if d)
@@ -19,7 +19,8 @@ def statfs(path: Path) -> str:
 
 
 def is_subvolume(path: Path) -> bool:
-    return path.is_dir() and statfs(path) == "btrfs" and path.stat().st_ino == 256
+    # Check the inode number first as that's a single stat() call whereas statfs() spawns a process.
+    return path.is_dir() and path.stat().st_ino == 256 and statfs(path) == "btrfs"
 
 
 def make_tree(config: MkosiConfig, path: Path) -> None:
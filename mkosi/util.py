@@ -62,12 +62,16 @@ def format_rlimit(rlimit: int) -> str:
     return f"{soft}:{hard}"
 
 
-def sort_packages(packages: Iterable[str]) -> list[str]:
-    """Sorts packages: normal first, paths second, conditional third"""
-
+@functools.lru_cache(maxsize=128)
+def _sort_packages(packages: tuple[str, ...]) -> tuple[str, ...]:
     m = {"(": 2, "/": 1}
     sort = lambda name: (m.get(name[0], 0), name)
-    return sorted(packages, key=sort)
+    return tuple(sorted(packages, key=sort))
+
+
+def sort_packages(packages: Iterable[str]) -> list[str]:
+    """Sorts packages: normal first, paths second, conditional third"""
+    return list(_sort_packages(tuple(packages)))
 
 
 def flatten(lists: Iterable[Iterable[T]]) -> list[T]:
@@ -75,6 +79,23 @@ def flatten(lists: Iterable[Iterable[T]]) -> list[T]:
     return list(itertools.chain.from_iterable(lists))
 
 
+def is_empty_dir(path: Path) -> bool:
+    with os.scandir(path) as it:
+        return next(it, None) is None
+
+
+def glob_prefix(path: Path, prefix: str) -> list[str]:
+    """
+    Return the names of the entries in path that start with prefix, like path.glob(f"{prefix}*") but without
+    going through fnmatch or constructing a Path for every entry. Returns an empty list if path does not exist.
+    """
+    try:
+        with os.scandir(path) as it:
+            return [e.name for e in it if e.name.startswith(prefix)]
+    except FileNotFoundError:
+        return []
+
+
 class InvokingUser:
     @staticmethod
     def _uid_from_env() -> Optional[int]:
@@ -157,6 +178,12 @@ def qemu_check_vsock_support(log: bool) -> bool:
     return True
 
 
+def write_all(fd: int, buf: bytes) -> None:
+    view = memoryview(buf)
+    while view:
+        view = view[os.write(fd, view):]
+
+
 def format_bytes(num_bytes: int) -> str:
     if num_bytes >= 1024**3:
         return f"{num_bytes/1024**3 :0.1f}G"
@@ -0,0 +1,201 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import email.utils
+import http.server
+import os
+import threading
+import urllib.error
+from collections.abc import Iterator
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from mkosi.download import CHUNK_SIZE, CONNECTIONS, USER_AGENT, close_connections, fetch, urlopen
+
+LAST_MODIFIED = "Wed, 01 Jan 2020 00:00:00 GMT"
+DATA = os.urandom(3 * CHUNK_SIZE + 123)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    ranges = True
+    truncate = False
+    clients: set[tuple[str, int]]
+    requests: list[tuple[str, str, dict[str, str]]]
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def do_HEAD(self) -> None:
+        self.respond(body=False)
+
+    def do_GET(self) -> None:
+        self.respond(body=True)
+
+    def respond(self, body: bool) -> None:
+        self.clients.add(self.client_address)
+        self.requests.append((self.command, self.path, dict(self.headers)))
+
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/data")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if (ims := self.headers.get("If-Modified-Since")):
+            if email.utils.parsedate_to_datetime(ims) >= email.utils.parsedate_to_datetime(LAST_MODIFIED):
+                self.send_response(304)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        data = DATA
+        if self.ranges and (r := self.headers.get("Range")):
+            start, end = map(int, r.removeprefix("bytes=").split("-"))
+            data = DATA[start:end + 1]
+            self.send_response(206)
+        else:
+            self.send_response(200)
+
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.end_headers()
+
+        if body:
+            if self.truncate:
+                self.wfile.write(data[:len(data) // 2])
+                self.close_connection = True
+            else:
+                self.wfile.write(data)
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch) -> Iterator[tuple[str, type[Handler]]]:
+    # urlopen() defers to urllib when a proxy is configured, which would bypass the code under test.
+    for k in list(os.environ):
+        if k.lower().endswith("_proxy"):
+            monkeypatch.delenv(k)
+
+    handler = type("TestHandler", (Handler,), dict(clients=set(), requests=[]))
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        yield f"http://127.0.0.1:{httpd.server_port}", handler
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+        thread.join()
+
+
+def test_fetch_ranges(server: tuple[str, type[Handler]], tmp_path: Path) -> None:
+    url, handler = server
+    dst = tmp_path / "data"
+
+    assert fetch(f"{url}/data", dst, workers=4)
+    assert dst.read_bytes() == DATA
+    assert dst.stat().st_mtime == email.utils.parsedate_to_datetime(LAST_MODIFIED).timestamp()
+    assert len([r for r in handler.requests if "Range" in r[2]]) == 4
+
+
+def test_fetch_no_ranges(server: tuple[str, type[Handler]], tmp_path: Path) -> None:
+    url, handler = server
+    handler.ranges = False
+    dst = tmp_path / "data"
+
+    assert fetch(f"{url}/data", dst)
+    assert dst.read_bytes() == DATA
+    assert not any("Range" in r[2] for r in handler.requests)
+
+
+def test_fetch_not_modified(server: tuple[str, type[Handler]], tmp_path: Path) -> None:
+    url, handler = server
+    dst = tmp_path / "data"
+    timestamp = email.utils.parsedate_to_datetime(LAST_MODIFIED).timestamp()
+
+    # The server answers 304 Not Modified.
+    assert not fetch(f"{url}/data", dst, if_newer_than=timestamp)
+    # The server ignores If-Modified-Since but the remote file is not newer.
+    handler.requests.clear()
+    assert not fetch(f"{url}/data", dst, if_newer_than=timestamp + 60)
+    assert not dst.exists()
+    assert [r[0] for r in handler.requests] == ["HEAD"]
+
+
+def test_urlopen_redirect(server: tuple[str, type[Handler]]) -> None:
+    url, _ = server
+
+    with urlopen(f"{url}/redirect", method="HEAD") as r:
+        assert r.status == 200
+        assert r.url == f"{url}/data"
+
+    with urlopen(f"{url}/redirect") as r:
+        assert r.read() == DATA
+
+
+def test_urlopen_http_error(server: tuple[str, type[Handler]]) -> None:
+    url, _ = server
+
+    with pytest.raises(urllib.error.HTTPError) as e:
+        with urlopen(f"{url}/data", headers={"If-Modified-Since": LAST_MODIFIED}):
+            pass
+
+    assert e.value.code == 304
+
+
+def test_urlopen_connection_reuse(server: tuple[str, type[Handler]]) -> None:
+    url, handler = server
+
+    for _ in range(3):
+        with urlopen(f"{url}/data") as r:
+            assert r.read() == DATA
+        with urlopen(f"{url}/data", method="HEAD") as r:
+            pass
+
+    assert len(handler.requests) == 6
+    assert len(handler.clients) == 1
+
+    # A response that wasn't read completely can't be reused, so we should get a new connection afterwards.
+    with urlopen(f"{url}/data") as r:
+        r.read(10)
+    with urlopen(f"{url}/data") as r:
+        assert r.read() == DATA
+
+    assert len(handler.clients) == 2
+
+    close_connections()
+    assert not CONNECTIONS
+
+    with urlopen(f"{url}/data", method="HEAD") as r:
+        pass
+
+    assert len(handler.clients) == 3
+
+
+def test_urlopen_user_agent(server: tuple[str, type[Handler]]) -> None:
+    url, handler = server
+
+    with urlopen(f"{url}/data", method="HEAD"):
+        pass
+    with urlopen(f"{url}/data", method="HEAD", headers={"User-Agent": "test"}):
+        pass
+
+    assert [r[2]["User-Agent"] for r in handler.requests] == [USER_AGENT, "test"]
+
+
+def test_fetch_interrupted(server: tuple[str, type[Handler]], tmp_path: Path) -> None:
+    url, handler = server
+    handler.ranges = False
+    handler.truncate = True
+    dst = tmp_path / "data"
+
+    with pytest.raises(SystemExit):
+        fetch(f"{url}/data", dst)
+
+    assert list(tmp_path.iterdir()) == []